@@ -94,9 +94,15 @@ consisting of
 
 import numpy as np
 import matplotlib.pyplot as plt
-from matplotlib.ticker import (MultipleLocator, AutoMinorLocator)
+from matplotlib.ticker import (MultipleLocator, AutoMinorLocator, ScalarFormatter)
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 import sys
+import os
 import array
+import glob
+import multiprocessing
+import zipfile
 
 
 DSCR_VIRT_VDIVS = 8
@@ -119,6 +125,7 @@ argsHelp = """
 Usage:
     --file <path/dso_saved_buf_file>
       the saved buf file that should be plotted
+      not needed when rendering only the files specified using --files.
 
     --format <buf|dat|auto>
       load either the dat or the buf signal/waveform dump/save file
@@ -138,6 +145,9 @@ Usage:
       same additionally to the original signal data.
       convolve or convolve:[w1,w2,...wN]
       fft or fft:ratioOfDataTowardsEndToClearToZero
+      NOTE: The guided digital decoding and the up/down freq count use the
+      digital edges of the unfiltered data, so they ignore this filter. Use
+      --dthresholds if required to tune the same.
 
     --showfft <no|yes|samplingrate>
       no: dont show fft plot [the default].
@@ -202,6 +212,56 @@ Usage:
       NOTE: This only works for buf files and not dat files, bcas dat
       files dont have time or voltage info in them.
 
+    --files <path1,path2,...>
+      additional buf files (glob patterns allowed), captured using the same
+      timebase, which form the batch of captures used by --align.
+
+    --correlate <no|all|01,02,13,...>
+      use fft based cross correlation with sub sample peak interpolation, to
+      find the lag (in time) of the 1st channel wrt the 2nd channel, wrt the
+      specified channel pairs of the capture. all means all channel pairs.
+
+    --align <no|lags|avg>
+      lags: cross correlate the ytickschannel data of each of the captures
+      specified using --files with that of the template capture (ie --file),
+      and show the lag of each of them wrt the template.
+      avg: additionally align the captures using these lags and plot the
+      averaged waveform, which has a lower noise floor.
+      Captures whose timebase or vdiv/ypos (wrt the averaged channels) differs
+      from the template, or which dont correlate with it, are skipped.
+
+    --render <no|png|svg>
+      instead of showing the interactive plot window, render the --file and
+      --files captures into png|svg images, using the agg backend. The figure
+      and its axes are created only once and reused across captures.
+
+    --renderdir <path>
+      the dir into which the rendered images are saved. Defaults to current dir.
+      Captures are saved as <filename>.<png|svg>, using path instead of filename
+      if the same filename is used by captures in different dirs.
+
+    --contactsheet <no|ColsxRows>
+      tile the captures as thumbnails into contact sheet images, each of which
+      contains a grid of Cols x Rows captures. ex: 4x3
+
+    --workers <N>
+      number of worker processes used to render the images. Defaults to 1.
+
+    --dthresholds <lo:hi,lo:hi,lo:hi,lo:hi>
+      the low and high thresholds (in terms of plot data levels ie 0-199),
+      wrt each channel, used to convert the channel data into digital edges,
+      with hysteresis. If not specified or if auto is specified wrt a channel,
+      the same is infered from the min and max of the channel data.
+      ex: 80:120,,auto,90:110
+
+    --edgestore <no|yes|update>
+      no: convert channels data into digital edges in memory only [default].
+      yes: reuse the edges stored in path/file.buf.edges.npz, if it exists and
+      is newer than the capture file, else convert and store into the same.
+      The stored edges are reconverted if dtype or thresholds differ.
+      update: convert the channels data and store the edges afresh.
+      This is also applied wrt each buf file when rendering.
+
 Interactions:
     * clicking a location on the plot will give its voltage and time info
     * when two different locations have been clicked on the plot
@@ -229,9 +289,15 @@ Examples:
     An example of trying to look at midi data capture, which uses fft plot as well as checkString mechanisms
     ./dso-plotter.py --file Path/To/MidiCapture.BUF --overlaytimedivs 1/31250:S01234567sS01234567sS01234567s:0????????10????????10????????1 --channels 0 --showfft yes
 
+    An example of finding the skew between clock and data lines captured on C0 and C1, and aligning and averaging repeated captures
+    ./dso-plotter.py --file Path/To/DATA001.BUF --correlate 01 --files "Path/To/DATA0*.BUF" --align avg
+
+    An example of creating contact sheets of a capture archive for review
+    ./dso-plotter.py --files "Path/To/Archive/*.BUF" --render png --renderdir Path/To/Thumbs --contactsheet 4x3 --workers 4
+
 
 """
-argsValid = [ "file", "format", "channels", "dtype", "ytickschannel", "filterdata", "overlaytimedivs", "showfft" ]
+argsValid = [ "file", "format", "channels", "dtype", "ytickschannel", "filterdata", "overlaytimedivs", "showfft", "files", "correlate", "align", "render", "renderdir", "contactsheet", "workers", "dthresholds", "edgestore" ]
 def process_args(g, args):
     g['channels'] = "0123"
     g['dtype'] = "B"
@@ -239,6 +305,15 @@ def process_args(g, args):
     g['filterdata'] = ""
     g['format'] = "auto"
     g['showfft'] = "no"
+    g['files'] = ""
+    g['correlate'] = "no"
+    g['align'] = "no"
+    g['render'] = "no"
+    g['renderdir'] = "."
+    g['contactsheet'] = "no"
+    g['workers'] = "1"
+    g['dthresholds'] = ""
+    g['edgestore'] = "no"
     if len(args) < 2:
         args.append("--help")
     iArg = 0
@@ -259,14 +334,33 @@ def process_args(g, args):
     if g['ytickschannel'] == "?":
         g['ytickschannel'] = g['channels'][0]
     g['ytickschannel'] = int(g['ytickschannel'])
-    if g['format'] == "auto":
-        theFile = g['file'].lower()
-        if theFile.endswith(".buf"):
-            g['format'] = "buf"
-        elif theFile.endswith(".dat"):
-            g['format'] = "dat"
-        else:
-            print("ERRR:ProcessArgs: File type of [{}] unknown, explicitly set --format".format(theFile))
+    if (g['render'] == "no"):
+        g['format'] = file_format(g['file'], g['format'])
+    g['files'] = expand_files(g['files'])
+
+
+def file_format(fileName, fmt):
+    if fmt != "auto":
+        return fmt
+    theFile = fileName.lower()
+    if theFile.endswith(".buf"):
+        return "buf"
+    elif theFile.endswith(".dat"):
+        return "dat"
+    print("ERRR:FileFormat: File type of [{}] unknown, explicitly set --format".format(theFile))
+    return fmt
+
+
+def expand_files(sFiles):
+    files = []
+    for sFile in sFiles.split(","):
+        if sFile == "":
+            continue
+        gFiles = sorted(glob.glob(sFile))
+        if len(gFiles) == 0:
+            print("WARN:ExpandFiles: No files matching [{}]".format(sFile))
+        files.extend(gFiles)
+    return files
 
 
 vdivRefBase=25e-6
@@ -338,6 +432,9 @@ tdivList = [
 ]
 
 def parse_tdiv_index(ind):
+    if (ind < 0) or (ind >= len(tdivList)):
+        print("DBUG:ParseTDivIndex:{}: Corrupt or Unsupported/New Tdiv".format(ind))
+        exit(51)
     val = (tdivList[ind][1]+1)*(tdivList[ind][2]+1)*tdivRefBase
     return tdivList[ind][0], val
 
@@ -428,11 +525,7 @@ def show_info(ev):
                     timeAdjust = 0.5
                     bPlotTD = True
                 dx = tx + (otdivSigValPixels*timeAdjust)
-                cVal = g['ycFD'][round(dx)]
-                if cVal > g['ycDMid']:
-                    vtext = "1"
-                else:
-                    vtext = "0"
+                vtext = "{}".format(edges_level(g['edges'][g['ytickschannel']], round(dx)))
                 valueColor = 'r'
                 if check != "":
                     if (vtext == check) or (check == "?") or (check == "*"):
@@ -472,38 +565,13 @@ def show_info(ev):
     # Calc Up/Down/Freq
     x0 = int(g['prevX'])
     x1 = int(g['curX'])
-    pVal = g['ycFD'][x0]
-    dValACC = 0
-    if pVal < g['ycDMid']:
-        bFindUp = True
-    else:
-        bFindUp = False
-    cntUpDown = 0
-    if x0 < x1:
-        xD = 1
-    else:
-        xD = -1
-    for x in range(x0, x1, xD):
-        cVal = g['ycFD'][x]
-        dVal = cVal - pVal
-        dValACC += dVal
-        pVal = cVal
-        if dValACC > g['ycDThreshold']:
-            dValACC = 0
-            if bFindUp:
-                cntUpDown += 1
-                bFindUp = False
-        if dValACC < -g['ycDThreshold']:
-            dValACC = 0
-            if not bFindUp:
-                cntUpDown += 1
-                bFindUp = True
+    cntUpDown = edges_count(g['edges'][g['ytickschannel']], x0, x1)
     # All in
     xvDelta = xval-g['prevXVal']
     yvDelta = yval-g['prevYVal']
     if (cntUpDown == 0):
-        singleCycleTimeF1 = np.NaN
-        singleCycleTimeF2 = np.NaN
+        singleCycleTimeF1 = np.nan
+        singleCycleTimeF2 = np.nan
     else:
         singleCycleTimeF1 = xvDelta/cntUpDown
         singleCycleTimeF2 = xvDelta/(cntUpDown/2)
@@ -567,26 +635,135 @@ def show_fft(g):
     g['axFD'].plot(xd,fd)
 
 
+XCORR_MINPEAK = 0.1
+# fft of the template is calculated only once, and reused wrt all signals correlated against it
+def xcorr_template(td):
+    td = td - np.mean(td)
+    n = len(td)
+    nfft = 1 << (2*n-2).bit_length() # avoid circular wrap around of the correlation
+    return { 'n': n, 'nfft': nfft, 'fdc': np.conj(np.fft.rfft(td, nfft)), 'norm': np.sqrt(np.sum(td*td)) }
+
+
+# lag (in samples) by which cd is delayed wrt template t, along with the normalised peak
+# lag is nan if there is no correlation
+def xcorr_lag(cd, t):
+    cd = cd - np.mean(cd)
+    n = t['n']
+    norm = np.sqrt(np.sum(cd*cd)) * t['norm']
+    if norm == 0:
+        return np.nan, np.nan
+    xc = np.fft.irfft(np.fft.rfft(cd, t['nfft'])*t['fdc'], t['nfft'])
+    xc = np.concatenate((xc[t['nfft']-(n-1):], xc[:n])) # lags -(n-1) to (n-1)
+    k = np.argmax(xc)
+    peak = xc[k]/norm
+    if not (peak >= XCORR_MINPEAK):
+        return np.nan, peak
+    frac = 0.0 # sub sample lag, from parabola through the peak and its neighbours
+    if (k > 0) and (k < len(xc)-1):
+        den = xc[k-1] - 2*xc[k] + xc[k+1]
+        if den != 0:
+            frac = 0.5*(xc[k-1] - xc[k+1])/den
+    return k - (n-1) + frac, peak
+
+
+# shift data left by the (fractional) lag, so that it aligns with the template
+def shift_data(cd, lag):
+    x = np.arange(len(cd))
+    return np.interp(x + lag, x, cd)
+
+
+def correlate_channels(g, cd):
+    if g['correlate'] == "all":
+        pairs = [ "{}{}".format(i, j) for i in range(NUM_CHANNELS) for j in range(i+1, NUM_CHANNELS) ]
+    else:
+        pairs = g['correlate'].split(",")
+    for pair in pairs:
+        if (len(pair) != 2) or (pair[0] not in "0123456789") or (pair[1] not in "0123456789") or (int(pair[0]) >= NUM_CHANNELS) or (int(pair[1]) >= NUM_CHANNELS):
+            print("ERRR:CorrelateChannels: Invalid channel pair [{}], specify as 2 channel digits ex: 01".format(pair))
+            exit(1)
+    # displayed channels already have partial data window fixed
+    for i in set([ int(c) for c in "".join(pairs) ]):
+        if not ("{}".format(i) in g['channels']):
+            cd[i] = fixif_partialdata_window(cd[i], i)
+    templates = {}
+    for pair in pairs:
+        i = int(pair[0])
+        j = int(pair[1])
+        if j not in templates:
+            templates[j] = xcorr_template(cd[j])
+        lag, peak = xcorr_lag(cd[i], templates[j])
+        if np.isnan(lag):
+            print("INFO:CorrelateChannels:C{}wrtC{}: No correlation, Peak[{}]".format(i, j, peak))
+            continue
+        print("INFO:CorrelateChannels:C{}wrtC{}: Lag[{} samples] [{}s] Peak[{}]".format(i, j, round(lag, 3), lag*g['tpixel'], round(peak, 3)))
+
+
+# align the g['files'] captures wrt the template data cd, based on lag of their ytickschannel data,
+# and return the displayed channels data averaged over all the aligned captures including template
+def align_captures(g, cd):
+    yc = g['ytickschannel']
+    chans = [ i for i in range(NUM_CHANNELS) if ("{}".format(i) in g['channels']) ]
+    if yc not in chans:
+        chans.append(yc)
+    t = xcorr_template(cd[yc])
+    acc = np.copy(cd)
+    cnt = 1
+    for fileName in g['files']:
+        if os.path.abspath(fileName) == os.path.abspath(g['file']):
+            continue
+        gf = {}
+        if not load_buffile(gf, fileName, g['dtype'], yc):
+            print("WARN:AlignCaptures:{}: Skipping".format(fileName))
+            continue
+        fcd = gf['cd']
+        if gf['timebase'] != g['timebase']:
+            print("WARN:AlignCaptures:{}: Skipping, timebase {} differs from template".format(fileName, gf['timebase']))
+            continue
+        bSkip = False
+        for i in chans:
+            if (gf['vdiv'][i] != g['vdiv'][i]) or (gf['ypos'][i] != g['ypos'][i]):
+                print("WARN:AlignCaptures:{}:C{}: Skipping, vdiv/ypos {}/{} differs from template".format(fileName, i, gf['vdiv'][i], gf['ypos'][i]))
+                bSkip = True
+                break
+        if bSkip:
+            continue
+        for i in chans:
+            fcd[i] = fixif_partialdata_window(fcd[i], i)
+        lag, peak = xcorr_lag(fcd[yc], t)
+        if np.isnan(lag):
+            print("WARN:AlignCaptures:{}:C{}: Skipping, No correlation, Peak[{}]".format(fileName, yc, peak))
+            continue
+        print("INFO:AlignCaptures:{}:C{}: Lag[{} samples] [{}s] Peak[{}]".format(fileName, yc, round(lag, 3), lag*g['tpixel'], round(peak, 3)))
+        for i in chans:
+            acc[i] += shift_data(fcd[i], lag)
+        cnt += 1
+    avg = np.copy(cd)
+    avg[chans] = acc[chans]/cnt
+    rms = np.sqrt(np.mean((cd[yc] - avg[yc])**2))
+    print("INFO:AlignCaptures:C{}: Averaged {} captures, Template vs Avg rms diff [{}]".format(yc, cnt, rms))
+    return avg
+
+
 DATFILE_TOTALSIZE = 2048
 DATFILE_CHANNELSIZE = 512
-def plot_datfile(g):
-    f = open(g['file'], "rb")
+DATFILE_DATASIZE = 0x188
+DATFILE_YPOSINDEX = 0x18d
+def read_datfile(fileName, dtype):
+    f = open(fileName, "rb")
     d = f.read()
+    f.close()
     if (len(d) != DATFILE_TOTALSIZE):
-        print("ERRR:PlotDatFile:FileSize doesnt match")
+        print("ERRR:ReadDatFile:{}:FileSize doesnt match".format(fileName))
         exit(1)
-    da = array.array(g['dtype']) # control whether to treat as signed or unsigned
-    da.frombytes(d)
-    cd = np.zeros((NUM_CHANNELS, DATFILE_CHANNELSIZE))
-    g['ypos'] = np.zeros((NUM_CHANNELS, 1))
-    for i in range(0, DATFILE_TOTALSIZE):
-        cid = int(i/DATFILE_CHANNELSIZE)
-        dind = i % DATFILE_CHANNELSIZE
-        if dind >= 0x188:
-            if dind == 0x18d:
-                g['ypos'][cid] = da[i]
-            continue
-        cd[cid, dind] = da[i]
+    # dtype controls whether to treat as signed or unsigned
+    da = np.frombuffer(d, dtype=np.dtype(dtype)).reshape(NUM_CHANNELS, DATFILE_CHANNELSIZE)
+    cd = da.astype(float)
+    cd[:, DATFILE_DATASIZE:] = 0
+    return cd, da[:, DATFILE_YPOSINDEX].astype(float)
+
+
+def plot_datfile(g):
+    cd, g['ypos'] = read_datfile(g['file'], g['dtype'])
     fig, ax = plt.subplots()
     for i in range(NUM_CHANNELS):
         if not ("{}".format(i) in g['channels']):
@@ -605,26 +782,192 @@ def plot_datfile(g):
     plt.show()
 
 
-def plot_buffile(g):
-    f = open(g['file'], "rb")
+# returns meta data, adjusted data of all channels and raw data of channel yc
+def read_buffile(fileName, dtype, yc):
+    f = open(fileName, "rb")
     d = f.read()
+    f.close()
     if (len(d) != HORI_ALLWINDOWS_SPACE*NUM_CHANNELS+BUFFILE_META_SIZE):
-        print("ERRR:PlotBufFile:FileSize doesnt match")
+        print("ERRR:ReadBufFile:{}:FileSize doesnt match".format(fileName))
         exit(1)
-    da = array.array(g['dtype']) # control whether to treat as signed or unsigned
-    da.frombytes(d)
-    g['meta'] = d[len(d)-BUFFILE_META_SIZE:]
-    parse_meta(g)
-    cd = np.zeros((NUM_CHANNELS, HORI_ALLWINDOWS_SPACE))
-    rd = np.zeros(HORI_ALLWINDOWS_SPACE)
+    # dtype controls whether to treat as signed or unsigned
+    da = np.frombuffer(d, dtype=np.dtype(dtype), count=HORI_ALLWINDOWS_SPACE*NUM_CHANNELS)
+    da = da.reshape(HORI_ALLWINDOWS_SPACE, NUM_CHANNELS).T
+    rd = da[yc].astype(float)
+    cd = adj_ydata(da.astype(float))
+    return d[len(d)-BUFFILE_META_SIZE:], cd, rd
+
+
+# load the buf file data and its parsed meta into gf, returns False if it is corrupt
+def load_buffile(gf, fileName, dtype, yc):
+    try:
+        gf['meta'], gf['cd'], gf['rd'] = read_buffile(fileName, dtype, yc)
+        parse_meta(gf)
+    except (SystemExit, OSError, IndexError, ValueError):
+        return False
+    return True
+
+
+DIGITAL_HYSTERESIS = 0.35 # wrt half of the channel data swing, on either side of mid
+# thresholds wrt each channel, either as specified or else infered from min and max of channel data
+def digital_thresholds(cd, sThresholds):
+    sThs = sThresholds.split(",")
+    ths = []
+    for i in range(NUM_CHANNELS):
+        if (i < len(sThs)) and (sThs[i] != "") and (sThs[i] != "auto"):
+            lo, hi = sThs[i].split(":")
+            ths.append((float(lo), float(hi)))
+            continue
+        dMin = np.min(cd[i])
+        dMax = np.max(cd[i])
+        dMid = (dMin + dMax)/2
+        dHys = (dMid - dMin)*DIGITAL_HYSTERESIS
+        ths.append((dMid - dHys, dMid + dHys))
+    return ths
+
+
+# level changes to 1 only when data reaches hi, and to 0 only when data goes below lo
+# edges store contains the starting level and the sample indexes where the level toggles
+def digitize_edges(cd, lo, hi):
+    above = cd >= hi
+    below = cd < lo
+    xd = np.arange(len(cd))
+    # index of the last sample at or before each sample which decided the level
+    lastDecided = np.maximum.accumulate(np.where(above | below, xd, -1))
+    if cd[0] >= (lo + hi)/2:
+        start = 1
+    else:
+        start = 0
+    levels = np.where(lastDecided < 0, start, above[lastDecided]).astype(np.int8)
+    edges = np.flatnonzero(np.diff(levels)) + 1
+    return { 'n': len(cd), 'start': int(levels[0]), 'edges': edges.astype(np.min_scalar_type(len(cd))), 'lo': lo, 'hi': hi }
+
+
+def edges_level(e, x):
+    return e['start'] ^ (np.searchsorted(e['edges'], x, side='right') & 1)
+
+
+def edges_count(e, x0, x1):
+    if x0 > x1:
+        x0, x1 = x1, x0
+    return int(np.searchsorted(e['edges'], x1, side='right') - np.searchsorted(e['edges'], x0, side='right'))
+
+
+# start times, levels and durations of the runs of same level
+def edges_runs(e, tpixel):
+    starts = np.concatenate(([0], e['edges'])).astype(int)
+    durations = np.diff(np.concatenate((starts, [e['n']])))
+    levels = (e['start'] + np.arange(len(starts))) % 2
+    return starts*tpixel, levels, durations*tpixel
+
+
+# freq and duty cycle, excluding the partial runs at either end of the capture
+def edges_info(e, tpixel):
+    times, levels, durations = edges_runs(e, tpixel)
+    if len(durations) < 4:
+        return np.nan, np.nan
+    durations = durations[1:-1]
+    levels = levels[1:-1]
+    freq = (len(durations)/2)/np.sum(durations)
+    duty = np.sum(durations[levels == 1])/np.sum(durations)
+    return freq, duty
+
+
+# edges of all channels are stored as a single array of deltas (which compress well),
+# along with a info array of dtype and wrt each channel n, start, lo, hi, numOfEdges
+def edges_save(fileName, edges, dtype):
+    info = [ ord(dtype) ]
+    deltas = []
+    for e in edges:
+        info.extend([ e['n'], e['start'], e['lo'], e['hi'], len(e['edges']) ])
+        deltas.append(np.diff(e['edges'].astype(int), prepend=0))
+    deltas = np.concatenate(deltas)
+    if len(deltas) > 0:
+        deltas = deltas.astype(np.min_scalar_type(np.max(deltas)))
+    # save into a temp file and then rename, so that a interrupted save doesnt leave a truncated store
+    tmpFile = "{}.{}.tmp.npz".format(fileName, os.getpid())
+    np.savez_compressed(tmpFile, info=np.array(info, dtype=float), deltas=deltas)
+    os.replace(tmpFile, fileName)
+    print("INFO:EdgesSave:{}: Saved".format(fileName))
+
+
+# returns the dtype and the edges store wrt all the channels
+def edges_load(fileName):
+    with np.load(fileName) as ed:
+        info = ed['info']
+        deltas = ed['deltas'].astype(int)
+    edges = []
+    iDelta = 0
+    for i in range(NUM_CHANNELS):
+        n, start, lo, hi, cnt = info[1+i*5:1+(i+1)*5]
+        cnt = int(cnt)
+        e = { 'n': int(n), 'start': int(start), 'lo': lo, 'hi': hi }
+        e['edges'] = np.cumsum(deltas[iDelta:iDelta+cnt]).astype(np.min_scalar_type(e['n']))
+        iDelta += cnt
+        edges.append(e)
+    return chr(int(info[0])), edges
+
+
+# stored edges are reused only if they match the current dtype, thresholds and data length
+def edges_valid(edges, dtype, cd, ths, g):
+    if dtype != g['dtype']:
+        return False
+    for i in range(NUM_CHANNELS):
+        e = edges[i]
+        if (e['n'] != len(cd[i])) or (not np.isclose(e['lo'], ths[i][0])) or (not np.isclose(e['hi'], ths[i][1])):
+            return False
+    return True
+
+
+def edges_setup(g, cd):
+    edgesFile = g['file'] + ".edges.npz"
+    ths = digital_thresholds(cd, g['dthresholds'])
+    g['edges'] = None
+    if (g['edgestore'] == "yes") and os.path.exists(edgesFile) and (os.path.getmtime(edgesFile) >= os.path.getmtime(g['file'])):
+        # its only a cache, so a damaged store is treated as stale
+        try:
+            dtype, edges = edges_load(edgesFile)
+            if edges_valid(edges, dtype, cd, ths, g):
+                g['edges'] = edges
+        except (OSError, ValueError, KeyError, IndexError, zipfile.BadZipFile):
+            pass
+        if g['edges'] is None:
+            print("INFO:EdgesSetup:{}: Stale wrt dtype/thresholds or damaged, rebuilding".format(edgesFile))
+        else:
+            print("INFO:EdgesSetup:{}: Loaded".format(edgesFile))
+    if g['edges'] is None:
+        g['edges'] = []
+        for i in range(NUM_CHANNELS):
+            g['edges'].append(digitize_edges(cd[i], ths[i][0], ths[i][1]))
+        if g['edgestore'] != "no":
+            edges_save(edgesFile, g['edges'], g['dtype'])
+    for i in range(NUM_CHANNELS):
+        e = g['edges'][i]
+        freq, duty = edges_info(e, g['tpixel'])
+        print("INFO:EdgesSetup:C{}: Thresholds[{} to {}] Edges[{}] Freq[{}] Duty[{}]".format(i, round(e['lo'], 2), round(e['hi'], 2), len(e['edges']), freq, duty))
+
+
+# returns ylimits, (yticks, ylabels), (xticks, xlabels) and voltage range, wrt ytickschannel and timebase
+def buf_ticks(g):
     yc = g['ytickschannel']
-    for i in range(0, HORI_ALLWINDOWS_SPACE*NUM_CHANNELS, NUM_CHANNELS):
-        j = int(i/NUM_CHANNELS)
-        rd[j] = da[i+yc]
-        cd[0,j] = adj_ydata(da[i])
-        cd[1,j] = adj_ydata(da[i+1])
-        cd[2,j] = adj_ydata(da[i+2])
-        cd[3,j] = adj_ydata(da[i+3])
+    yvB = - g['ypos'][yc] * g['vpixel'][yc]
+    yvT = (VIRT_DATASPACE - g['ypos'][yc]) * g['vpixel'][yc]
+    if g['dtype'] == 'b':
+        yB = -(VIRT_DATASPACE/2)
+        yT = (VIRT_DATASPACE/2)-1
+    else:
+        yB = 0
+        yT = VIRT_DATASPACE-1
+    labels = np.linspace(yvB, yvT, DSCR_VIRT_VDIVS+1)
+    xticks = np.arange(0, HORI_ALLWINDOWS_SPACE, HORI_TDIV_DATASAMPLES*10)
+    xlabels = friendly_times(xticks*g['tpixel'])
+    return (yB, yT), (np.linspace(yB, yT, DSCR_VIRT_VDIVS+1), labels), (xticks, xlabels), (yvB, yvT)
+
+
+def plot_buffile(g):
+    yc = g['ytickschannel']
+    g['meta'], cd, rd = read_buffile(g['file'], g['dtype'], yc)
+    parse_meta(g)
 
     if g['showfft'] != "no" :
         fig, ax = plt.subplots(2,1)
@@ -647,15 +990,21 @@ def plot_buffile(g):
         ax.annotate("C{}:{}".format(i, g['vdiv'][i]), (0,cd[i][0]))
         ax.axhline(g['ypos'][i], color=lines[0].get_color(), alpha=0.4)
         if i == yc:
-            yvB = - g['ypos'][i] * g['vpixel'][i]
-            yvT = (VIRT_DATASPACE - g['ypos'][i]) * g['vpixel'][i]
             g['ycFD'] = fd
 
-    g['ycDMin'] = np.min(cd[yc])
-    g['ycDMax'] = np.max(cd[yc])
-    g['ycDMid'] = (g['ycDMin'] + g['ycDMax'])/2
-    g['ycDThreshold'] = (g['ycDMid'] - g['ycDMin'])*0.7
-    print("INFO:PlotBufFile:C{}: Data Raw[{} to {}] Adjusted[{} to {}] Mid[{}] Threshold[{}]".format(yc, np.min(rd), np.max(rd), g['ycDMin'], g['ycDMax'], g['ycDMid'], g['ycDThreshold']))
+    if g['correlate'] != "no":
+        correlate_channels(g, cd)
+    if g['align'] != "no":
+        avg = align_captures(g, cd)
+        if g['align'] == "avg":
+            for i in range(NUM_CHANNELS):
+                if not ("{}".format(i) in g['channels']):
+                    continue
+                ax.plot(avg[i], alpha=0.7)
+                ax.annotate("C{}:Avg".format(i), (0,avg[i][0]))
+
+    edges_setup(g, cd)
+    print("INFO:PlotBufFile:C{}: Data Raw[{} to {}] Adjusted[{} to {}] DThresholds[{} to {}]".format(yc, np.min(rd), np.max(rd), np.min(cd[yc]), np.max(cd[yc]), g['edges'][yc]['lo'], g['edges'][yc]['hi']))
     print("INFO:PlotBufFile:C{}:\n\tHistoRaw:{}\n\tHistoAdj:{}".format(yc, np.histogram(rd), np.histogram(cd[yc])))
 
     if g['showfft'] != "no" :
@@ -664,21 +1013,13 @@ def plot_buffile(g):
     ax.grid(True)
     #plt.locator_params('both', tight=True)
     #plt.locator_params('y', nbins=8)
-    if g['dtype'] == 'b':
-        yB = -(VIRT_DATASPACE/2)
-        yT = (VIRT_DATASPACE/2)-1
-    else:
-        yB = 0
-        yT = VIRT_DATASPACE-1
-    ax.set_ylim(yB, yT)
-    labels = np.linspace(yvB, yvT, DSCR_VIRT_VDIVS+1)
-    ax.set_yticks(np.linspace(yB, yT, DSCR_VIRT_VDIVS+1), labels)
-    g['yvB'] = yvB
-    g['yvT'] = yvT
-    g['yvPixel'] = (yvT-yvB)/VIRT_DATASPACE
-    xticks = np.arange(0, HORI_ALLWINDOWS_SPACE, HORI_TDIV_DATASAMPLES*10)
-    xlabels = friendly_times(xticks*g['tpixel'])
-    ax.set_xticks(xticks, xlabels)
+    ylim, yticks, xticks, yv = buf_ticks(g)
+    ax.set_ylim(ylim)
+    ax.set_yticks(*yticks)
+    g['yvB'] = yv[0]
+    g['yvT'] = yv[1]
+    g['yvPixel'] = (yv[1]-yv[0])/VIRT_DATASPACE
+    ax.set_xticks(*xticks)
     ax.xaxis.set_minor_locator(MultipleLocator(HORI_TDIV_DATASAMPLES))
     g['prevXYText'] = ax.text(0, 0.95, "", transform=ax.transAxes, fontfamily="monospace")
     g['curXYText'] = ax.text(0, 0.90, "", transform=ax.transAxes, fontfamily="monospace")
@@ -693,9 +1034,204 @@ def plot_buffile(g):
     plt.show()
 
 
-process_args(g, sys.argv)
-print(g)
-if g['format'] == "dat":
-    plot_datfile(g)
-else:
-    plot_buffile(g)
+RENDER_FIGSIZE = (16, 8)
+RENDER_THUMBSIZE = (4, 2.5)
+gr = {}
+def render_init(rg):
+    gr['g'] = rg
+    gr['figs'] = {}
+
+
+# returns None if the capture file is corrupt
+def render_load(rg, fileName):
+    gf = dict(rg)
+    gf['file'] = fileName
+    gf['format'] = file_format(fileName, rg['format'])
+    if gf['format'] == "dat":
+        try:
+            gf['cd'], gf['ypos'] = read_datfile(fileName, rg['dtype'])
+        except (SystemExit, OSError):
+            print("WARN:RenderLoad:{}: Skipping".format(fileName))
+            return None
+        return gf
+    if not load_buffile(gf, fileName, rg['dtype'], rg['ytickschannel']):
+        print("WARN:RenderLoad:{}: Skipping".format(fileName))
+        return None
+    for i in range(NUM_CHANNELS):
+        if ("{}".format(i) in rg['channels']):
+            gf['cd'][i] = fixif_partialdata_window(gf['cd'][i], i)
+    if rg['edgestore'] != "no":
+        edges_setup(gf, gf['cd'])
+    return gf
+
+
+# figure is created only once wrt each worker and inturn reused across captures
+# sType can be single or sheet (ie thumbnails of captures in a grid)
+def render_fig(rg, sType):
+    if sType in gr['figs']:
+        return gr['figs'][sType]
+    if sType == "sheet":
+        nCols, nRows = rg['sheetgrid']
+        fig = Figure(figsize=(RENDER_THUMBSIZE[0]*nCols, RENDER_THUMBSIZE[1]*nRows))
+        axs = fig.subplots(nRows, nCols, squeeze=False).flatten()
+    else:
+        fig = Figure(figsize=RENDER_FIGSIZE)
+        axs = [ fig.subplots() ]
+    FigureCanvasAgg(fig)
+    rf = { 'fig': fig, 'axs': [], 'bLayout': False }
+    for ax in axs:
+        ra = { 'ax': ax, 'lines': [], 'ylines': [], 'anns': [], 'key': None }
+        for i in range(NUM_CHANNELS):
+            bShow = ("{}".format(i) in rg['channels'])
+            lines = ax.plot([], [], visible=bShow)
+            ra['lines'].append(lines[0])
+            ra['ylines'].append(ax.axhline(0, color=lines[0].get_color(), alpha=0.4, visible=bShow))
+            if sType != "sheet":
+                ra['anns'].append(ax.annotate("", (0, 0), visible=bShow))
+        if sType == "sheet":
+            ra['title'] = ax.set_title("", fontsize="small")
+            ax.tick_params(labelbottom=False, labelleft=False)
+        else:
+            ra['title'] = ax.set_title("")
+        ax.grid(True)
+        rf['axs'].append(ra)
+    gr['figs'][sType] = rf
+    return rf
+
+
+# swap in the capture data, ticks are updated only if timebase or ytickschannel ypos/vdiv changes
+def render_capture(ra, gf):
+    ax = ra['ax']
+    cd = gf['cd']
+    xd = np.arange(cd.shape[1])
+    for i in range(NUM_CHANNELS):
+        ra['lines'][i].set_data(xd, cd[i])
+        ra['ylines'][i].set_ydata([gf['ypos'][i], gf['ypos'][i]])
+        if len(ra['anns']) > 0:
+            ra['anns'][i].xy = (0, cd[i][0])
+            ra['anns'][i].set_position((0, cd[i][0]))
+            if gf['format'] == "dat":
+                ra['anns'][i].set_text("C{}".format(i))
+            else:
+                ra['anns'][i].set_text("C{}:{}".format(i, gf['vdiv'][i]))
+    if len(ra['anns']) > 0:
+        ra['title'].set_text(gf['file'])
+    else:
+        ra['title'].set_text(os.path.basename(gf['file']))
+    ax.set_xlim(0, len(xd)-1)
+    if gf['format'] == "dat":
+        key = ( "dat", )
+    else:
+        yc = gf['ytickschannel']
+        key = ( "buf", gf['timebase'], gf['ypos'][yc], gf['vpixel'][yc] )
+    if ra['key'] != key:
+        ra['key'] = key
+        if gf['format'] == "dat":
+            ax.xaxis.set_major_locator(MultipleLocator(HORI_TDIV_DATASAMPLES))
+            ax.yaxis.set_major_locator(MultipleLocator(VIRT_VDIV_LEVELS))
+            ax.xaxis.set_major_formatter(ScalarFormatter())
+            ax.yaxis.set_major_formatter(ScalarFormatter())
+        else:
+            ylim, yticks, xticks, yv = buf_ticks(gf)
+            ax.set_ylim(ylim)
+            ax.set_yticks(*yticks)
+            ax.set_xticks(*xticks)
+            ax.xaxis.set_minor_locator(MultipleLocator(HORI_TDIV_DATASAMPLES))
+    if gf['format'] == "dat":
+        ax.set_ylim(min(np.min(cd), np.min(gf['ypos'])) - 5, max(np.max(cd), np.max(gf['ypos'])) + 5)
+
+
+# returns the number of images and captures rendered
+def render_job(job):
+    outFile, files = job
+    rg = gr['g']
+    cnt = 0
+    if rg['contactsheet'] == "no":
+        rf = render_fig(rg, "single")
+        gf = render_load(rg, files[0])
+        if gf is None:
+            return 0, cnt
+        render_capture(rf['axs'][0], gf)
+        cnt += 1
+    else:
+        rf = render_fig(rg, "sheet")
+        for i in range(len(rf['axs'])):
+            ra = rf['axs'][i]
+            gf = None
+            if i < len(files):
+                gf = render_load(rg, files[i])
+            ra['ax'].set_visible(gf is not None)
+            if gf is not None:
+                render_capture(ra, gf)
+                cnt += 1
+        if cnt == 0:
+            return 0, cnt
+    if not rf['bLayout']:
+        rf['fig'].tight_layout()
+        rf['bLayout'] = True
+    rf['fig'].savefig(outFile, format=rg['render'])
+    print("INFO:RenderJob:{}: Saved".format(outFile))
+    return 1, cnt
+
+
+# unique image file name wrt each capture, using its path if its name is reused across dirs
+def render_names(files, ext):
+    names = []
+    baseNames = [ os.path.basename(f) for f in files ]
+    for i in range(len(files)):
+        name = baseNames[i]
+        if baseNames.count(name) > 1:
+            name = os.path.relpath(files[i]).replace("..", "").replace(os.sep, "_").replace("/", "_").lstrip("_")
+        cName = name
+        k = 1
+        while "{}.{}".format(cName, ext) in names:
+            cName = "{}-{}".format(name, k)
+            k += 1
+        names.append("{}.{}".format(cName, ext))
+    return names
+
+
+def render_files(g):
+    files = []
+    absFiles = set()
+    for f in ([ g['file'] ] if 'file' in g else []) + g['files']:
+        if os.path.abspath(f) in absFiles:
+            continue
+        absFiles.add(os.path.abspath(f))
+        files.append(f)
+    rg = {}
+    for k in [ "channels", "dtype", "ytickschannel", "format", "render", "renderdir", "contactsheet", "dthresholds", "edgestore" ]:
+        rg[k] = g[k]
+    if rg['contactsheet'] != "no":
+        nCols, nRows = rg['contactsheet'].lower().split("x")
+        rg['sheetgrid'] = (int(nCols), int(nRows))
+        n = rg['sheetgrid'][0]*rg['sheetgrid'][1]
+        jobs = []
+        for i in range(0, len(files), n):
+            jobs.append((os.path.join(rg['renderdir'], "sheet{:04}.{}".format(len(jobs), rg['render'])), files[i:i+n]))
+    else:
+        names = render_names(files, rg['render'])
+        jobs = [ (os.path.join(rg['renderdir'], names[i]), [ files[i] ]) for i in range(len(files)) ]
+    os.makedirs(rg['renderdir'], exist_ok=True)
+    workers = int(g['workers'])
+    if workers > 1:
+        chunkSize = max(1, len(jobs)//(workers*4))
+        with multiprocessing.Pool(workers, render_init, (rg,)) as pool:
+            res = list(pool.imap_unordered(render_job, jobs, chunkSize))
+    else:
+        render_init(rg)
+        res = list(map(render_job, jobs))
+    imgs = sum([ r[0] for r in res ])
+    cnt = sum([ r[1] for r in res ])
+    print("INFO:RenderFiles: Rendered {} of {} captures into {} images in {}".format(cnt, len(files), imgs, rg['renderdir']))
+
+
+if __name__ == "__main__":
+    process_args(g, sys.argv)
+    print(g)
+    if g['render'] != "no":
+        render_files(g)
+    elif g['format'] == "dat":
+        plot_datfile(g)
+    else:
+        plot_buffile(g)